@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""dist: compile preprocessed translation units on remote worker nodes.
+
+This module implements both halves of kcc's distributed compilation mode. The
+client (kcc) preprocesses each translation unit locally and sends the result,
+along with the compiler flags, to a worker. The worker compiles it to an
+object file and sends the object back with the compiler's diagnostics. Since
+the source is already preprocessed, workers need nothing but a compiler; no
+headers or libraries have to be installed on them. Linking stays local.
+
+Compilers are named generically (gcc, g++, clang or clang++) and the client
+sends the version and target of the compiler it preprocessed with; a worker
+refuses the job unless its own compiler of that name matches both, rather than
+produce objects with a different compiler.
+
+Example client usage:
+  host = Host.parse("localhost:3632/4")
+  result = compile_remote(host, ["g++", "-x", "c++-cpp-output", "-O3"],
+                          "foo.ii", open("foo.ii", "rb").read(),
+                          "12.2.0", "x86_64-linux-gnu")
+  if result["returncode"] == 0:
+    open("foo.o", "wb").write(result["object"])
+
+The result dictionary has the following information:
+  returncode: exit status of the compiler on the worker
+  stdout: the compiler's standard output
+  stderr: the compiler's standard error (its diagnostics)
+  object: contents of the object file, or an empty string on failure
+
+Workers are started with serve(), by running this module directly or with the
+kccd script; several instances may run on one machine, each on its own port. A
+worker only runs the compilers named in COMPILERS and only accepts the flags
+allowed by check_args: language standards, warnings, optimization, debugging,
+code generation (-f and -m; -f flags taking a value only when listed in
+ALLOWED_VALUE_FLAGS, and never the forms dumping, profiling, loading files or
+running programs) and macro definitions. Anything else, including a second -x,
+is rejected. Workers should still only be reachable from trusted machines.
+
+The wire protocol is deliberately simple. Every message is a four-byte
+big-endian length, a JSON header of that length and then the payloads whose
+sizes are listed in the header's "sizes" entry, in order.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import socket
+import SocketServer
+import struct
+import sys
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+
+DEFAULT_PORT = 3632
+DEFAULT_LIMIT = 2
+PROTOCOL_VERSION = 2
+CONNECT_TIMEOUT = 5.0
+COMPILE_TIMEOUT = 600.0
+
+COMPILERS = ("gcc", "g++", "cc", "c++", "clang", "clang++")
+LANGUAGES = {"cpp-output": ".i", "c++-cpp-output": ".ii"}
+ALLOWED_FLAGS = ("-std=", "-W", "-O", "-g", "-f", "-m", "-D", "-U")
+ALLOWED_EXACT_FLAGS = ("-ansi", "-pedantic", "-pedantic-errors", "-w",
+                       "-pthread")
+# the only -f flags which may take a value (-fFLAG=VALUE)
+ALLOWED_VALUE_FLAGS = ("-fabi-version=", "-falign-functions=",
+                       "-falign-jumps=", "-falign-labels=", "-falign-loops=",
+                       "-fcf-protection=", "-fconstexpr-depth=",
+                       "-fconstexpr-loop-limit=", "-fconstexpr-ops-limit=",
+                       "-fdiagnostics-color=", "-fdiagnostics-column-unit=",
+                       "-fdiagnostics-show-location=", "-fdiagnostics-urls=",
+                       "-fexcess-precision=", "-ffp-contract=",
+                       "-fmax-errors=", "-fmessage-length=",
+                       "-fno-sanitize=", "-fsanitize=", "-fsanitize-recover=",
+                       "-ftabstop=", "-ftemplate-depth=", "-ftls-model=",
+                       "-ftrivial-auto-var-init=", "-fvisibility=")
+# flags matching ALLOWED_FLAGS which read or write files, or run other programs
+FORBIDDEN_FLAGS = ("-Wl,", "-Wa,", "-Wp,", "-fdump-", "-fplugin",
+                   "-fprofile", "-fauto-profile", "-fdiagnostics-format",
+                   "-fdiagnostics-add-output", "-fdiagnostics-set-output",
+                   "-fopt-info", "-fsave-optimization-record",
+                   "-fcallgraph-info", "-fcompare-debug", "-fmodule",
+                   "-fdeps-")
+
+class DistError(Exception):
+  "raised when a remote compilation fails for reasons other than the source"
+  pass
+
+class Host(object):
+  """Host: address of a worker and how many jobs it may run for us at once.
+  
+  Hosts are written as HOST[:PORT][/LIMIT], like distcc's host lists, and may
+  be separated by commas or whitespace when parsed with Host.parse_list.
+  """
+  def __init__(self, name, port = DEFAULT_PORT, limit = DEFAULT_LIMIT):
+    self.name = name
+    self.port = port
+    self.limit = limit
+  
+  def __repr__(self):
+    return "Host(%s:%d/%d)" % (self.name, self.port, self.limit)
+  
+  @staticmethod
+  def parse(spec):
+    "parse a single HOST[:PORT][/LIMIT] specification"
+    limit = DEFAULT_LIMIT
+    port = DEFAULT_PORT
+    if "/" in spec:
+      spec, limit = spec.rsplit("/", 1)
+      limit = int(limit)
+    if ":" in spec:
+      spec, port = spec.rsplit(":", 1)
+      port = int(port)
+    if not spec or limit < 1:
+      raise ValueError("invalid host specification")
+    return Host(spec, port, limit)
+  
+  @staticmethod
+  def parse_list(specs):
+    "parse a comma- or whitespace-separated list of hosts"
+    return [Host.parse(s) for s in specs.replace(",", " ").split()]
+
+def _recv_exactly(sock, size):
+  chunks = []
+  while size > 0:
+    chunk = sock.recv(min(size, 65536))
+    if not chunk:
+      raise DistError("connection closed by peer")
+    chunks.append(chunk)
+    size -= len(chunk)
+  return "".join(chunks)
+
+def send_message(sock, header, *payloads):
+  "send a header dictionary followed by any number of payload strings"
+  header = dict(header)
+  header["sizes"] = [len(p) for p in payloads]
+  data = json.dumps(header)
+  sock.sendall(struct.pack(">I", len(data)) + data)
+  for payload in payloads:
+    sock.sendall(payload)
+
+def recv_message(sock):
+  "receive a message, returning its header and the list of its payloads"
+  size = struct.unpack(">I", _recv_exactly(sock, 4))[0]
+  try:
+    header = json.loads(_recv_exactly(sock, size))
+    sizes = [int(s) for s in header.get("sizes", [])]
+  except (ValueError, TypeError):
+    raise DistError("malformed message header")
+  return header, [_recv_exactly(sock, s) for s in sizes]
+
+def check_args(args):
+  "raise DistError unless a worker may run the given compiler command"
+  if not args or os.path.basename(args[0]) != args[0] or \
+     args[0] not in COMPILERS:
+    raise DistError("compiler not allowed: %r" % (args[:1],))
+  if len(args) < 3 or args[1] != "-x" or args[2] not in LANGUAGES:
+    raise DistError("source must be preprocessed")
+  for arg in args[3:]:
+    if not arg.startswith("-"):
+      raise DistError("input files are not allowed: %s" % (arg,))
+    allowed = arg in ALLOWED_EXACT_FLAGS or arg.startswith(ALLOWED_FLAGS)
+    if not allowed or arg.startswith(FORBIDDEN_FLAGS):
+      raise DistError("flag not allowed: %s" % (arg,))
+    if arg.startswith("-f") and "=" in arg:
+      if not arg.startswith(ALLOWED_VALUE_FLAGS):
+        raise DistError("flag not allowed: %s" % (arg,))
+      if "/" in arg or "\\" in arg or ".." in arg:
+        raise DistError("paths are not allowed: %s" % (arg,))
+
+def compiler_identity(compiler):
+  "return the (version, target) of a compiler, or None if it cannot be run"
+  result = []
+  for option in (["-dumpfullversion", "-dumpversion"], ["-dumpmachine"]):
+    try:
+      p = Popen([compiler] + option, stdout = PIPE, stderr = PIPE)
+      out, err = p.communicate()
+    except OSError:
+      return None
+    words = out.split()
+    if p.returncode != 0 or not words:
+      return None
+    result.append(words[0])
+  return tuple(result)
+
+def compile_remote(host, args, filename, source, version, machine,
+                   cwd = None):
+  """Compile a preprocessed translation unit on a worker.
+  
+  The args list is the compiler command without input or output files; it
+  must begin with the compiler's name followed by "-x cpp-output" or "-x
+  c++-cpp-output". version and machine are what the compiler which
+  preprocessed the source reports for -dumpfullversion and -dumpmachine; the
+  worker refuses to compile with anything else. filename is only used to name
+  the source on the worker.
+  Raises DistError (or socket.error) if the worker could not be reached or
+  could not run the compiler, in which case the caller should compile locally.
+  """
+  sock = socket.create_connection((host.name, host.port), CONNECT_TIMEOUT)
+  try:
+    sock.settimeout(COMPILE_TIMEOUT)
+    send_message(sock, {"version": PROTOCOL_VERSION, "args": args,
+                        "compiler": [version, machine],
+                        "filename": os.path.basename(filename),
+                        "cwd": cwd or os.getcwd()}, source)
+    header, payloads = recv_message(sock)
+  finally:
+    sock.close()
+  if header.get("error"):
+    raise DistError(header["error"])
+  if len(payloads) != 3:
+    raise DistError("malformed reply")
+  return {
+    "returncode": header.get("returncode", -1),
+    "stdout": payloads[0],
+    "stderr": payloads[1],
+    "object": payloads[2]
+  }
+
+class _WorkerHandler(SocketServer.BaseRequestHandler):
+  def handle(self):
+    try:
+      header, payloads = recv_message(self.request)
+      if header.get("version") != PROTOCOL_VERSION:
+        raise DistError("unsupported protocol version %r" %
+                        (header.get("version"),))
+      args = [str(a) for a in header.get("args", [])]
+      check_args(args)
+      self._check_compiler(args[0], header.get("compiler"))
+      if len(payloads) != 1:
+        raise DistError("expected exactly one source file")
+      with self.server.jobs:
+        reply = self._compile(args, header, payloads[0])
+    except (DistError, ValueError, TypeError, struct.error), e:
+      self.server.log("%s: rejected: %s" % (self.client_address[0], e))
+      reply = ({"error": str(e)},)
+    except socket.error, e:
+      self.server.log("%s: %s" % (self.client_address[0], e))
+      return
+    try:
+      send_message(self.request, *reply)
+    except socket.error, e:
+      self.server.log("%s: %s" % (self.client_address[0], e))
+  
+  def _check_compiler(self, compiler, wanted):
+    with self.server.lock:
+      if compiler not in self.server.compilers:
+        self.server.compilers[compiler] = compiler_identity(compiler)
+      have = self.server.compilers[compiler]
+    if have is None:
+      raise DistError("unable to run %s" % (compiler,))
+    if not wanted or list(have) != list(wanted):
+      raise DistError("%s here is %s for %s, client needs %s" %
+                      (compiler, have[0], have[1],
+                       " for ".join(wanted or ["an unknown version"])))
+  
+  def _compile(self, args, header, source):
+    scratch = tempfile.mkdtemp(prefix = "kccd-")
+    try:
+      name = os.path.splitext(os.path.basename(header.get("filename", "")))[0]
+      srcfile = os.path.join(scratch, (name or "source") + LANGUAGES[args[2]])
+      objfile = os.path.join(scratch, "output.o")
+      with open(srcfile, "wb") as fobj:
+        fobj.write(source)
+      command = args + ["-c", srcfile, "-o", objfile]
+      if header.get("cwd"):
+        command.append("-fdebug-prefix-map=%s=%s" % (scratch, header["cwd"]))
+      self.server.log("%s: %s" % (self.client_address[0], " ".join(command)))
+      try:
+        p = Popen(command, stdout = PIPE, stderr = PIPE, cwd = scratch)
+        out, err = p.communicate()
+      except OSError, e:
+        raise DistError("unable to run %s: %s" % (args[0], e))
+      obj = ""
+      if p.returncode == 0 and os.path.exists(objfile):
+        with open(objfile, "rb") as fobj:
+          obj = fobj.read()
+      return ({"returncode": p.returncode}, out, err, obj)
+    finally:
+      shutil.rmtree(scratch, ignore_errors = True)
+
+class Worker(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """Worker: a server compiling preprocessed sources for kcc clients.
+  
+  At most jobs compilations run at the same time; further requests wait for a
+  free slot. Log messages are passed to the log function, if given.
+  """
+  allow_reuse_address = True
+  daemon_threads = True
+  def __init__(self, address, jobs = None, log = None):
+    SocketServer.TCPServer.__init__(self, address, _WorkerHandler)
+    self.jobs = threading.BoundedSemaphore(jobs or _cpu_count())
+    self.compilers = {} # name -> (version, target), or None if unusable
+    self.lock = threading.Lock()
+    self.log = log or (lambda message: None)
+
+def _cpu_count():
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except (ImportError, NotImplementedError):
+    return 1
+
+def serve(address = "127.0.0.1", port = DEFAULT_PORT, instances = 1,
+          jobs = None, log = None):
+  """Run one or more workers on consecutive ports until interrupted.
+  
+  Running several instances on one machine is mostly useful for testing the
+  distributed mode on localhost.
+  """
+  workers = [Worker((address, port + i), jobs, log) for i in range(instances)]
+  threads = []
+  for worker in workers:
+    t = threading.Thread(target = worker.serve_forever)
+    t.daemon = True
+    t.start()
+    threads.append(t)
+    if log is not None:
+      log("listening on %s:%d" % worker.server_address)
+  try:
+    while any(t.is_alive() for t in threads):
+      for t in threads:
+        t.join(1.0)
+  except KeyboardInterrupt:
+    pass
+  for worker in workers:
+    worker.shutdown()
+    worker.server_close()
+
+def main(argv = None):
+  "command-line entry point for the reference worker daemon"
+  parser = optparse.OptionParser(usage = "usage: %prog [OPTIONS]",
+                                 description = "Compile preprocessed sources"
+                                 " sent by kcc's distributed mode.")
+  parser.add_option("-a", "--address", default = "127.0.0.1",
+                    help = "address to listen on (default: %default)")
+  parser.add_option("-p", "--port", type = "int", default = DEFAULT_PORT,
+                    help = "port of the first instance (default: %default)")
+  parser.add_option("-n", "--instances", type = "int", default = 1,
+                    metavar = "N", help = "run N instances on consecutive"
+                    " ports (default: %default)")
+  parser.add_option("-j", "--jobs", type = "int", default = None,
+                    metavar = "N", help = "run at most N compilations at once"
+                    " per instance (default: number of processors)")
+  parser.add_option("-q", "--quiet", action = "store_true", default = False,
+                    help = "do not log requests to stderr")
+  options, args = parser.parse_args(argv)
+  if args:
+    parser.error("unexpected arguments: %s" % (" ".join(args),))
+  def log(message):
+    sys.stderr.write("kccd: %s\n" % (message,))
+  serve(options.address, options.port, options.instances, options.jobs,
+        None if options.quiet else log)
+
+if __name__ == "__main__":
+  main()
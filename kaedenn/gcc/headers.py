@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+r"""gcc.headers: build include graphs from the output of gcc -H.
+
+When given -H, gcc prints the name of every header it opens to stderr, prefixed
+by one dot per level of nesting:
+  . /usr/include/stdio.h
+  .. /usr/include/features.h
+  . foo.h
+followed, optionally, by a list of headers lacking include guards:
+  Multiple include guards may be useful for:
+  /usr/include/features-time64.h
+
+Example usage:
+  g = IncludeGraph()
+  for unit in ("foo.c", "bar.c"):
+    start = time.time()
+    p = Popen(["gcc", "-E", "-H", unit, "-o", os.devnull], stderr = PIPE)
+    err = p.communicate()[1]
+    diagnostics = g.add(unit, err, time.time() - start)
+  sys.stdout.write(g.report(limit = 20))
+
+Headers are ranked by the number of bytes they make the preprocessor read over
+the whole build. Timing each header on its own is too noisy to rank on, so the
+time shown is only an estimate: each translation unit's preprocessing time is
+split among its headers in proportion to the bytes they pull in.
+
+For each header, the graph keeps a dictionary with the following information:
+  path: path of the header, as printed by gcc
+  size: size of the header itself, in bytes (or -1 if it cannot be read)
+  inclusive: size of the header plus every header opened while including it,
+             in bytes (the largest seen across all translation units)
+  count: number of times the header was opened across all translation units
+  total: bytes read because of the header (its inclusive size each time it
+         was opened), summed over all translation units
+  units: the set of translation units including it, directly or not
+  direct: the set of translation units including it directly
+  parents: the set of headers including it directly
+  guarded: False if gcc suggested adding an include guard to it
+  time: estimated preprocessing time spent because of the header, summed over
+        all translation units, in seconds (or None if no time was given)
+"""
+
+import os
+import re
+
+class IncludeGraph(object):
+  """IncludeGraph: collect the include trees of a set of translation units
+  
+  Exports the following members:
+  
+  self.add(unit, output, seconds = None) -> list
+    add the include tree gcc -H printed for a translation unit, returning the
+    lines of output which are not part of it (gcc's diagnostics); seconds is
+    the time taken to preprocess the unit, if known
+  
+  self.headers() -> list
+    return the paths of every header seen so far
+  
+  self.get(path) -> dict
+    return the information gathered on a header
+  
+  self.report(limit = None) -> string
+    format a table of the headers costing the most across the build
+  """
+  GUARDS_HEADING = "Multiple include guards may be useful for:"
+  TIME_RESOLUTION = 0.0001 # estimates below this are noise
+  def __init__(self):
+    self._headers = {}
+    self._units = []
+    self._tree_line = re.compile(r"^(?P<depth>\.+) (?P<path>.+)$")
+  
+  def _header(self, path):
+    if path not in self._headers:
+      try:
+        size = os.path.getsize(path)
+      except OSError:
+        size = -1
+      self._headers[path] = {
+        "path": path,
+        "size": size,
+        "inclusive": 0,
+        "count": 0,
+        "total": 0,
+        "units": set(),
+        "direct": set(),
+        "parents": set(),
+        "guarded": True,
+        "time": None
+      }
+    return self._headers[path]
+  
+  def add(self, unit, output, seconds = None):
+    "add the output of gcc -H for a translation unit, returning the rest"
+    self._units.append(unit)
+    others = []
+    stack = [] # (header, inclusive size so far) for each open level
+    opened = [] # (header, inclusive size) for each time a header was opened
+    def close(depth):
+      while len(stack) > depth:
+        header, size = stack.pop()
+        header["inclusive"] = max(header["inclusive"], size)
+        opened.append((header, size))
+        if stack:
+          stack[-1] = (stack[-1][0], stack[-1][1] + size)
+    in_guards = False
+    for line in output.splitlines():
+      m = self._tree_line.match(line)
+      if m is not None and not in_guards:
+        depth = len(m.group("depth"))
+        close(depth - 1)
+        header = self._header(m.group("path"))
+        header["count"] += 1
+        header["units"].add(unit)
+        if stack:
+          header["parents"].add(stack[-1][0]["path"])
+        else:
+          header["direct"].add(unit)
+        stack.append((header, max(header["size"], 0)))
+      elif line.strip() == IncludeGraph.GUARDS_HEADING:
+        in_guards = True
+      elif in_guards and line.strip() in self._headers:
+        self._headers[line.strip()]["guarded"] = False
+      else:
+        in_guards = False
+        others.append(line)
+    close(0)
+    try:
+      unit_bytes = os.path.getsize(unit)
+    except OSError:
+      unit_bytes = 0
+    unit_bytes += sum(max(h["size"], 0) for h, size in opened)
+    for header, size in opened:
+      header["total"] += size
+      if seconds is not None and unit_bytes > 0:
+        header["time"] = (header["time"] or 0.0) + seconds * size / unit_bytes
+    return others
+  
+  def headers(self):
+    "return the paths of all headers seen so far"
+    return sorted(self._headers)
+  
+  def get(self, path):
+    "return the information gathered on a header"
+    return self._headers[path]
+  
+  def _cost(self, header):
+    return (header["total"], len(header["units"]))
+  
+  def report(self, limit = None):
+    "format a table of the costliest headers, costliest first"
+    headers = sorted(self._headers.values(), key = self._cost, reverse = True)
+    if limit is not None:
+      headers = headers[:limit]
+    lines = ["%d translation units, %d distinct headers, %d headers opened" %
+             (len(self._units), len(self._headers),
+              sum(h["count"] for h in self._headers.values())),
+             "%11s %10s %10s %6s %5s %7s  %s" % ("total bytes", "incl bytes",
+                                                 "bytes", "opened", "units",
+                                                 "~ms", "header")]
+    for h in headers:
+      if h["time"] is None or h["time"] < IncludeGraph.TIME_RESOLUTION:
+        estimate = "-"
+      else:
+        estimate = "%.1f" % (h["time"] * 1000,)
+      path = h["path"]
+      if not h["guarded"]:
+        path += " (include guard suggested)"
+      lines.append("%11d %10d %10d %6d %5d %7s  %s" %
+                   (h["total"], h["inclusive"], h["size"], h["count"],
+                    len(h["units"]), estimate, path))
+    return "\n".join(lines) + "\n"
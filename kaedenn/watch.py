@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""watch: wait for files to change.
+
+This module defines two watchers with the same interface: InotifyWatcher,
+which asks the Linux kernel to report changes through inotify, and
+PollingWatcher, which compares modification times every so often and works
+everywhere. Use Watcher() to get the best one available.
+
+Example usage:
+  w = Watcher()
+  while True:
+    start = time.time()
+    w.watch(["foo.c", "foo.h"])
+    headers = build()
+    w.watch(headers, since = start)
+    changed = w.wait(["foo.c", "foo.h"] + headers)
+    sys.stderr.write("changed: %s\\n" % (", ".join(changed),))
+
+Saving a file often produces a burst of events (editors write a backup, then
+the file, then change its attributes), so wait() only returns once no further
+changes were seen for the debounce period. Changes made to a file after
+watch() (or an earlier wait()) was given it, for instance while a build is
+running, are reported by the next call to wait(). Files only discovered after
+the build started can be given to watch() with the build's start time, so that
+they count as changed if they were modified after it.
+
+The inotify watcher watches the directories containing the files rather than
+the files themselves, so that editors replacing a file by renaming a new one
+over it are noticed.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+DEFAULT_DEBOUNCE = 0.1
+DEFAULT_INTERVAL = 0.25
+
+def _normalize(paths):
+  return set(os.path.abspath(p) for p in paths)
+
+def _modified_since(path, since):
+  if since is None:
+    return False
+  try:
+    return os.stat(path).st_mtime >= since
+  except OSError:
+    return False
+
+class PollingWatcher(object):
+  """PollingWatcher: notice changes by comparing modification times
+  
+  Files are checked every interval seconds; a file counts as changed when its
+  modification time or size changed, or when it appeared or disappeared.
+  """
+  def __init__(self, interval = DEFAULT_INTERVAL):
+    self._interval = interval
+    self._stamps = {}
+    self._pending = set()
+  
+  def _stamp(self, path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    return (st.st_mtime, st.st_size)
+  
+  def _changes(self, paths):
+    changed = set()
+    for path in paths:
+      stamp = self._stamp(path)
+      if path not in self._stamps:
+        self._stamps[path] = stamp
+      elif self._stamps[path] != stamp:
+        self._stamps[path] = stamp
+        changed.add(path)
+    return changed
+  
+  def watch(self, paths, since = None):
+    "start watching paths; new ones modified after since count as changed"
+    for path in _normalize(paths):
+      if path not in self._stamps:
+        self._stamps[path] = self._stamp(path)
+        if _modified_since(path, since):
+          self._pending.add(path)
+  
+  def wait(self, paths, debounce = DEFAULT_DEBOUNCE):
+    "block until some of paths change, returning the set of changed paths"
+    paths = _normalize(paths)
+    self.watch(paths)
+    changed = (self._pending & paths) | self._changes(paths)
+    self._pending = set()
+    while not changed:
+      time.sleep(self._interval)
+      changed = self._changes(paths)
+    while True:
+      time.sleep(debounce)
+      more = self._changes(paths)
+      if not more:
+        return changed
+      changed |= more
+
+class InotifyWatcher(object):
+  """InotifyWatcher: notice changes through Linux's inotify interface
+  
+  Raises OSError if inotify is not available.
+  """
+  IN_MODIFY = 0x00000002
+  IN_ATTRIB = 0x00000004
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+  IN_CLOEXEC = 0o2000000
+  EVENT = struct.Struct("iIII")
+  def __init__(self):
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+      raise OSError(errno.ENOSYS, "no C library to find inotify in")
+    self._libc = ctypes.CDLL(libc_name, use_errno = True)
+    if not hasattr(self._libc, "inotify_init1"):
+      raise OSError(errno.ENOSYS, "inotify is not supported")
+    self._fd = self._libc.inotify_init1(InotifyWatcher.IN_CLOEXEC)
+    if self._fd < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+    self._mask = (InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_MODIFY |
+                  InotifyWatcher.IN_ATTRIB | InotifyWatcher.IN_MOVED_FROM |
+                  InotifyWatcher.IN_MOVED_TO | InotifyWatcher.IN_CREATE |
+                  InotifyWatcher.IN_DELETE)
+    self._dirs = {} # watch descriptor -> directory
+    self._watched = set()
+    self._known = set()
+    self._pending = set()
+  
+  def close(self):
+    "stop watching and release the inotify descriptor"
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+  
+  def _watch_dirs(self, paths):
+    for directory in set(os.path.dirname(p) for p in paths):
+      if directory in self._watched:
+        continue
+      wd = self._libc.inotify_add_watch(self._fd, directory, self._mask)
+      if wd >= 0:
+        self._dirs[wd] = directory
+        self._watched.add(directory)
+  
+  def _read_events(self, timeout):
+    "return the paths named by the events arriving within timeout seconds"
+    ready, _, _ = select.select([self._fd], [], [], timeout)
+    if not ready:
+      return None
+    data = os.read(self._fd, 65536)
+    result = set()
+    offset = 0
+    while offset + InotifyWatcher.EVENT.size <= len(data):
+      wd, mask, cookie, length = InotifyWatcher.EVENT.unpack_from(data, offset)
+      offset += InotifyWatcher.EVENT.size
+      name = data[offset:offset + length].rstrip("\0")
+      offset += length
+      if wd in self._dirs and name:
+        result.add(os.path.join(self._dirs[wd], name))
+    return result
+  
+  def watch(self, paths, since = None):
+    "start watching paths; new ones modified after since count as changed"
+    paths = _normalize(paths)
+    self._watch_dirs(paths)
+    for path in paths - self._known:
+      if _modified_since(path, since):
+        self._pending.add(path)
+    self._known |= paths
+  
+  def wait(self, paths, debounce = DEFAULT_DEBOUNCE):
+    "block until some of paths change, returning the set of changed paths"
+    paths = _normalize(paths)
+    self.watch(paths)
+    changed = self._pending & paths
+    self._pending = set()
+    while not changed:
+      changed = (self._read_events(None) or set()) & paths
+    while True:
+      more = self._read_events(debounce)
+      if more is None:
+        return changed
+      changed |= more & paths
+
+def Watcher(log = None):
+  "return an InotifyWatcher if possible, or a PollingWatcher otherwise"
+  try:
+    return InotifyWatcher()
+  except OSError, e:
+    if log is not None:
+      log("inotify unavailable (%s), polling for changes instead" % (e,))
+    return PollingWatcher()